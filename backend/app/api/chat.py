@@ -1,10 +1,13 @@
 from fastapi import APIRouter, HTTPException, Cookie, Header
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import logging
 import uuid
-from app.services.agent import chat_agent_service
+from app.services.agent import ContextOutOfSync, chat_agent_service
 from app.services.chat_history import chat_history_service
+from app.services.prefetch import prefetch_service
+from app.utils.profiling import span
 
 # Setup logging
 logger = logging.getLogger(__name__)
@@ -18,7 +21,13 @@ class ChatMessage(BaseModel):
     content: str
 
 class ChatRequest(BaseModel):
-    messages: List[ChatMessage]
+    # Full transcript (legacy mode, or a resync in delta mode)
+    messages: Optional[List[ChatMessage]] = None
+    # New user message (delta mode)
+    message: Optional[str] = None
+    # Server context version and hash from the last response the client saw (delta mode)
+    context_version: Optional[int] = None
+    context_hash: Optional[str] = None
     system_prompt: Optional[str] = None
     session_id: Optional[str] = None
 
@@ -27,6 +36,58 @@ class ChatResponse(BaseModel):
     error: Optional[str] = None
     success: bool = True
     session_id: Optional[str] = None
+    # Server context after this turn; echo these back with the next delta request
+    context_version: Optional[int] = None
+    context_hash: Optional[str] = None
+    # Set when the client is out of sync and must resend the full transcript
+    resync_required: bool = False
+
+# Roles a client transcript may contain; the system prompt is always the server's own
+HISTORY_ROLES = ("user", "assistant")
+
+def _check_history(history: List[Dict[str, str]], resync: bool) -> List[Dict[str, str]]:
+    """
+    Keep only user and assistant messages of a client transcript
+    A resync with any other role is rejected, since it would replace the stored conversation
+    """
+    if resync and any(m["role"] not in HISTORY_ROLES for m in history):
+        raise HTTPException(status_code=400, detail="Transcript messages must have role user or assistant")
+    return [m for m in history if m["role"] in HISTORY_ROLES]
+
+def _split_transcript(messages: List[ChatMessage]):
+    """Split a transcript into the history and the last user message"""
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].role == "user":
+            history = [{"role": m.role, "content": m.content} for m in messages[:i]]
+            return history, messages[i].content
+    return [], None
+
+def _client_state(chat_request: ChatRequest) -> Dict[str, Any]:
+    """
+    Work out the new user message and how the request relates to the stored conversation
+    
+    Delta mode (`message` set): the client's context version/hash must match the
+    server's. A transcript in `messages` (with `message`, or with a context
+    version/hash after a 409) resyncs the server. Legacy mode (`messages` only):
+    the stored conversation wins and the transcript is only used when no state exists.
+    The agent applies this under the session lock.
+    """
+    if chat_request.message is not None:
+        if chat_request.messages:
+            # The client sent its full history along with the new message
+            history = [{"role": m.role, "content": m.content} for m in chat_request.messages]
+            return {"message": chat_request.message, "history": _check_history(history, True), "replace_history": True}
+        no_context = chat_request.context_version is None and chat_request.context_hash is None
+        return {
+            "message": chat_request.message,
+            # Either value identifies the client's view; a client sending neither expects a new conversation
+            "expected_version": 0 if no_context else chat_request.context_version,
+            "expected_hash": chat_request.context_hash,
+        }
+    
+    history, last_message = _split_transcript(chat_request.messages or [])
+    resync = chat_request.context_version is not None or chat_request.context_hash is not None
+    return {"message": last_message, "history": _check_history(history, resync), "replace_history": resync}
 
 @router.post("/send", response_model=ChatResponse)
 async def send_message(
@@ -37,36 +98,51 @@ async def send_message(
     """
     Endpoint to send a message to the chat agent and get a response
     Supports session tracking via cookies, headers, or request body
+    
+    Clients should send only the new `message` with the `context_version` and
+    `context_hash` from the previous response; a 409 with `resync_required`
+    asks them to resend the new `message` together with the full transcript in `messages`.
     """
     try:
         logger.debug(f"Received chat request: {chat_request}")
         
         # Determine session ID (prioritize request body, then header, then cookie)
-        active_session_id = chat_request.session_id or x_session_id or session_id
-        
-        # Extract the last user message
-        last_message = None
-        for message in reversed(chat_request.messages):
-            if message.role == "user":
-                last_message = message.content
-                break
+        active_session_id = chat_request.session_id or x_session_id or session_id or chat_history_service.default_session_id
         
+        # Extract the new user message; the agent checks it against the stored conversation
+        state = _client_state(chat_request)
+        last_message = state.pop("message")
         if not last_message:
             raise HTTPException(status_code=400, detail="No user message found in the request")
         
         # Generate response using Groq with memory
-        response = await chat_agent_service.generate_response(last_message, active_session_id)
-        
-        # Get or create a session ID
-        if not active_session_id:
-            active_session_id = chat_history_service.default_session_id
+        with span("chat.send.generate_response"):
+            try:
+                response, context_version, context_hash = await chat_agent_service.generate_synced_response(
+                    last_message, active_session_id, **state
+                )
+            except ContextOutOfSync as e:
+                logger.debug(str(e))
+                return JSONResponse(status_code=409, content=ChatResponse(
+                    response="",
+                    success=False,
+                    error="Conversation out of sync, resend the new message together with the full transcript in messages",
+                    session_id=active_session_id,
+                    context_version=e.version,
+                    context_hash=e.context_hash,
+                    resync_required=True
+                ).model_dump())
         
         return ChatResponse(
             response=response,
             success=True,
             error=None,
-            session_id=active_session_id
+            session_id=active_session_id,
+            context_version=context_version,
+            context_hash=context_hash
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing chat request: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -109,11 +185,13 @@ async def chat(
             logger.debug(f"No session ID provided, using default: {active_session_id}")
         
         # Ensure the conversation exists
-        active_session_id = chat_history_service.get_or_create_conversation(active_session_id)
+        with span("chat.get_or_create_conversation"):
+            active_session_id = chat_history_service.get_or_create_conversation(active_session_id)
         logger.debug(f"Ensured conversation exists with ID: {active_session_id}")
         
         # Generate response using Groq with memory
-        response = await chat_agent_service.generate_response(message, active_session_id)
+        with span("chat.generate_response"):
+            response = await chat_agent_service.generate_response(message, active_session_id)
         
         # Make sure to return a properly structured response
         logger.debug(f"Returning response with session ID: {active_session_id}")
@@ -245,6 +323,11 @@ async def test_endpoint():
     """Test endpoint for the chat router"""
     return {"message": "Chat router is working!"}
 
+@router.get("/prefetch/stats")
+async def get_prefetch_stats():
+    """Get follow-up prefetch counters and hit rate"""
+    return prefetch_service.get_stats()
+
 @router.get("/debug")
 async def debug_chat_status(
     session_id: Optional[str] = None,
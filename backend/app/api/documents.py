@@ -0,0 +1,140 @@
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional
+import json
+import logging
+from app.models.document import ChunkResult, DocumentAnalysisJob
+from app.services.document_analysis import document_analysis_service, DocumentTooLargeError, is_text_upload
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Initialize router
+router = APIRouter()
+
+# Define request models
+class TextAnalysisRequest(BaseModel):
+    text: str
+    framework: str = "NIST CSF"
+    question: Optional[str] = None
+    filename: str = "pasted-document"
+
+# Maximum number of partial results returned per page
+MAX_PARTIALS_PAGE = 100
+
+def _job_payload(job: DocumentAnalysisJob, new_partials: Optional[List[ChunkResult]] = None) -> dict:
+    """
+    Convert a job to a serializable status payload
+    Partial results are not included, since they grow with the document; stream
+    events carry only the ones finished since the previous event
+    """
+    payload = {
+        "job_id": job.id,
+        "filename": job.filename,
+        "framework": job.framework,
+        "status": job.status,
+        "total_chunks": job.total_chunks,
+        "completed_chunks": job.completed_chunks,
+        "failed_parts": job.failed_parts,
+        "result": job.result,
+        "error": job.error,
+        "updated_at": job.updated_at.isoformat(),
+    }
+    if new_partials is not None:
+        payload["new_partial_results"] = [result.model_dump() for result in new_partials]
+    return payload
+
+@router.post("/analyze")
+async def analyze_document(
+    file: UploadFile = File(...),
+    framework: str = Form("NIST CSF"),
+    question: Optional[str] = Form(None)
+):
+    """
+    Upload a policy document for gap analysis against a framework
+    The analysis runs in the background; poll or stream the returned job
+    Only plain text documents are accepted
+    """
+    if not is_text_upload(file.filename, file.content_type):
+        raise HTTPException(
+            status_code=415,
+            detail="Only plain text documents are supported; export PDF or Word policies to text first"
+        )
+    
+    job = document_analysis_service.create_job(file.filename or "uploaded-document", framework, question)
+    try:
+        await document_analysis_service.save_upload(job.id, file)
+    except Exception as e:
+        document_analysis_service.discard_job(job.id)
+        if isinstance(e, DocumentTooLargeError):
+            raise HTTPException(status_code=413, detail=str(e))
+        raise
+
+    document_analysis_service.start_job(job)
+    logger.debug(f"Started document analysis job {job.id}")
+    return _job_payload(job)
+
+@router.post("/analyze/text")
+async def analyze_text(request: TextAnalysisRequest):
+    """Submit pasted document text for gap analysis against a framework"""
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="No document text provided")
+
+    job = document_analysis_service.create_job(request.filename, request.framework, request.question)
+    try:
+        document_analysis_service.save_text(job.id, request.text)
+    except Exception as e:
+        document_analysis_service.discard_job(job.id)
+        if isinstance(e, DocumentTooLargeError):
+            raise HTTPException(status_code=413, detail=str(e))
+        raise
+
+    document_analysis_service.start_job(job)
+    logger.debug(f"Started document analysis job {job.id}")
+    return _job_payload(job)
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Get the progress and final result of an analysis job"""
+    job = document_analysis_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+    return _job_payload(job)
+
+@router.get("/jobs/{job_id}/partials")
+async def get_job_partials(
+    job_id: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_PARTIALS_PAGE)
+):
+    """
+    Get a page of an analysis job's per-part results, ordered by part number
+    Partial results are kept by the worker running the job; other workers return none
+    """
+    job = document_analysis_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+    results = sorted(job.chunk_results, key=lambda r: r.part)
+    return {
+        "job_id": job.id,
+        "offset": offset,
+        "total": len(results),
+        "partial_results": [result.model_dump() for result in results[offset:offset + limit]],
+    }
+
+@router.get("/jobs/{job_id}/stream")
+async def stream_job_status(job_id: str):
+    """Stream job progress as server-sent events until the job finishes"""
+    if not document_analysis_service.get_job(job_id):
+        raise HTTPException(status_code=404, detail="Analysis job not found")
+
+    async def event_stream():
+        sent = 0
+        async for job in document_analysis_service.stream_job(job_id):
+            # chunk_results only grows, so everything past what was sent is new
+            new_partials = job.chunk_results[sent:]
+            sent = len(job.chunk_results)
+            yield f"data: {json.dumps(_job_payload(job, new_partials))}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
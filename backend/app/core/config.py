@@ -17,7 +17,88 @@ class Settings(BaseSettings):
     # Groq API settings
     GROQ_API_KEY: str = Field(default="")
     GROQ_MODEL: str = "llama-3.3-70b-versatile"
-    
+
+    # LLM provider settings
+    # One of: groq, openai_compatible, record, replay
+    LLM_PROVIDER: str = "groq"
+    # Comma-separated providers tried in order when the primary one fails
+    LLM_FALLBACK_PROVIDERS: str = ""
+
+    # Upstream requests per minute allowed by the provider's rate limit
+    LLM_RATE_LIMIT_RPM: int = 30
+
+    # OpenAI-compatible server settings (e.g. a local inference server)
+    OPENAI_COMPAT_BASE_URL: str = "http://localhost:8080/v1"
+    OPENAI_COMPAT_API_KEY: str = ""
+    OPENAI_COMPAT_MODEL: str = "local-model"
+    OPENAI_COMPAT_TIMEOUT: float = 60.0
+
+    # Record/replay settings
+    LLM_RECORDING_PATH: str = "recordings/llm_traffic.jsonl"
+    # Provider whose traffic is captured when LLM_PROVIDER=record
+    LLM_RECORD_UPSTREAM: str = "groq"
+    # Multiplier applied to recorded latencies on replay (0 disables delays)
+    LLM_REPLAY_SPEED: float = 1.0
+
+    # Document analysis settings
+    DOCUMENT_UPLOAD_DIR: str = "uploads"
+    DOCUMENT_MAX_UPLOAD_BYTES: int = 20 * 1024 * 1024
+    DOCUMENT_CHUNK_CHARS: int = 12000
+    DOCUMENT_CHUNK_OVERLAP: int = 500
+    # Maximum number of LLM calls in flight per analysis job
+    DOCUMENT_ANALYSIS_CONCURRENCY: int = 4
+    # Number of partial results merged by each reduce call
+    DOCUMENT_REDUCE_FANOUT: int = 4
+    # Seconds a finished job stays available for polling
+    DOCUMENT_JOB_TTL: int = 3600
+
+    # Chat protocol settings
+    # Seed a session from the client's transcript when the server has no state for it
+    CHAT_TRUST_CLIENT_HISTORY: bool = True
+
+    # Session store settings
+    # "memory" keeps sessions in process (single worker); "sqlite" shares them between workers
+    SESSION_STORE: str = "memory"
+    SESSION_STORE_PATH: str = "data/sessions.db"
+    # Seconds to wait for a session held by another request
+    SESSION_LOCK_TIMEOUT: float = 120.0
+    # Seconds after which a session lock held by a crashed worker expires
+    SESSION_LOCK_TTL: float = 300.0
+
+    # Conversation recall settings
+    # When disabled the full session history is sent with every request
+    RECALL_ENABLED: bool = True
+    # Most recent messages always included in the prompt
+    RECALL_RECENT_MESSAGES: int = 6
+    # Maximum number of older messages recalled by relevance
+    RECALL_TOP_K: int = 4
+    # Character budget for recalled older messages
+    RECALL_BUDGET_CHARS: int = 6000
+
+    # Follow-up prefetch settings
+    PREFETCH_ENABLED: bool = False
+    # Number of predicted follow-ups answered after each turn
+    PREFETCH_MAX_FOLLOWUPS: int = 2
+    # Seconds the upstream must stay idle before prefetching starts
+    PREFETCH_IDLE_DELAY: float = 1.0
+    # Fraction of LLM_RATE_LIMIT_RPM that must remain unused for prefetching
+    PREFETCH_MIN_HEADROOM: float = 0.5
+    # Minimum term overlap (Jaccard) for a message to match a predicted follow-up
+    PREFETCH_MATCH_THRESHOLD: float = 0.6
+
+    # Profiling settings
+    # Allow clients to request a trace with the X-Profile header ("1" or "stacks")
+    PROFILING_HEADER_ENABLED: bool = False
+    # When set, X-Profile is only honored with a matching X-Profile-Token header
+    PROFILING_HEADER_SECRET: str = ""
+    # Fraction of requests traced without the header (0.0 - 1.0)
+    PROFILING_SAMPLE_RATE: float = 0.0
+    PROFILING_TRACE_PATH: str = "traces/traces.jsonl"
+    PROFILING_MAX_BYTES: int = 10 * 1024 * 1024
+    PROFILING_BACKUP_COUNT: int = 5
+    # Seconds between stack samples when the sampling profiler is on
+    PROFILING_STACK_INTERVAL: float = 0.005
+
     # Autogen settings
     AUTOGEN_MAX_TOKENS: int = 1024
     AUTOGEN_TEMPERATURE: float = 0.7
@@ -5,7 +5,9 @@ import os
 import logging
 import uvicorn
 from app.api.chat import router as chat_router
+from app.api.documents import router as documents_router
 from app.core.config import get_settings
+from app.utils.profiling import ProfilingMiddleware
 
 # Setup logging
 logging.basicConfig(
@@ -31,8 +33,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Trace requests that opt in with the X-Profile header or are sampled
+app.add_middleware(ProfilingMiddleware)
+
 # Include routers
 app.include_router(chat_router, prefix="/api/chat", tags=["chat"])
+app.include_router(documents_router, prefix="/api/documents", tags=["documents"])
 
 # Health check endpoint
 @app.get("/health")
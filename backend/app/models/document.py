@@ -0,0 +1,44 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+class ChunkResult(BaseModel):
+    """Analysis result for a single document chunk"""
+    # 1-based part number, as used in the prompts
+    part: int
+    content: Optional[str] = None
+    error: Optional[str] = None
+
+class DocumentAnalysisJob(BaseModel):
+    """Long-document analysis job processed with map-reduce"""
+    id: str = Field(default_factory=lambda: str(uuid4()))
+    filename: str
+    framework: str
+    question: Optional[str] = None
+    status: str = "pending"  # 'pending', 'mapping', 'reducing', 'completed' or 'failed'
+    total_chunks: int = 0
+    completed_chunks: int = 0
+    chunk_results: List[ChunkResult] = []
+    # Part numbers (1-based) of chunks whose analysis failed and is missing from the result
+    failed_parts: List[int] = []
+    result: Optional[str] = None
+    error: Optional[str] = None
+    # Incremented on every update so streaming clients can detect changes
+    version: int = 0
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+    @property
+    def is_finished(self) -> bool:
+        """Whether the job has reached a terminal state"""
+        return self.status in ("completed", "failed")
+
+    def is_expired(self, ttl_seconds: int) -> bool:
+        """Whether the job finished more than ttl_seconds ago"""
+        return self.is_finished and datetime.now() - self.updated_at > timedelta(seconds=ttl_seconds)
+
+    def touch(self) -> None:
+        """Mark the job as updated"""
+        self.version += 1
+        self.updated_at = datetime.now()
@@ -1,9 +1,14 @@
 import logging
 import os
-from app.services.llm import groq_llm_service
+from app.services.llm import LLMProvider
+from app.services.llm_providers import llm_provider
 from app.core.config import get_settings
 from app.services.chat_history import chat_history_service
-from typing import List, Dict, Any, Optional
+from app.services.recall import recall_service
+from app.services.prefetch import prefetch_service
+from app.services.session_store import SessionLockTimeout
+from app.utils.profiling import span
+from typing import List, Dict, Any, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
@@ -11,17 +16,29 @@ settings = get_settings()
 # Set environment variable to disable Docker requirement
 os.environ["AUTOGEN_USE_DOCKER"] = "False"
 
+class ContextOutOfSync(Exception):
+    """Raised when a client's context version or hash does not match the stored conversation"""
+    
+    def __init__(self, session_id: str, version: int, context_hash: str):
+        super().__init__(f"Client out of sync for session {session_id}, server at version {version}")
+        self.session_id = session_id
+        self.version = version
+        self.context_hash = context_hash
+
 class ChatAgentService:
-    """Service for managing chat agents using Groq"""
+    """Service for managing chat agents using a pluggable LLM provider"""
     
-    def __init__(self):
+    def __init__(self, provider: Optional[LLMProvider] = None):
         """Initialize the chat agent service"""
-        self.system_message = "You are a helpful AI assistant powered by Groq LLM. Provide accurate, concise, and helpful responses. You specialize in GRC (Governance, Risk, and Compliance) topics and policies."
+        self.llm_provider = provider or llm_provider
+        self.system_message = "You are a helpful AI assistant. Provide accurate, concise, and helpful responses. You specialize in GRC (Governance, Risk, and Compliance) topics and policies."
         logger.debug("Initializing chat agent service")
         logger.debug("Chat agent service initialized")
         
         # Store active conversations and their contexts
         self._active_contexts: Dict[str, List[Dict[str, str]]] = {}
+        # Chat history hash each context was last in sync with (shared session store only)
+        self._context_hashes: Dict[str, str] = {}
     
     def _get_context(self, session_id: str) -> List[Dict[str, str]]:
         """Get the current context for a session"""
@@ -33,11 +50,68 @@ class ChatAgentService:
         """Clear the context for a specific session"""
         if session_id in self._active_contexts:
             del self._active_contexts[session_id]
+        self._context_hashes.pop(session_id, None)
+        prefetch_service.clear(session_id)
         logger.debug(f"Cleared context for session: {session_id}")
     
+    def load_history(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        """Reset a session's context to the given history"""
+        self._active_contexts[session_id] = [{"role": "system", "content": self.system_message}] + [
+            {"role": m["role"], "content": m["content"]} for m in messages
+        ]
+        self._context_hashes[session_id] = chat_history_service.get_context_state(session_id)[2]
+        prefetch_service.clear(session_id)
+        logger.debug(f"Loaded {len(messages)} messages into context for session: {session_id}")
+    
+    def _build_prompt(self, session_id: str, message: str) -> List[Dict[str, str]]:
+        """Build the prompt from recent and recalled history for a new message"""
+        history = recall_service.build_history(session_id, message)
+        return [{"role": "system", "content": self.system_message}] + history + [{"role": "user", "content": message}]
+    
+    def _follow_up_prompt(self, session_id: str, question: str) -> List[Dict[str, str]]:
+        """Build the prompt a follow-up question would be sent with"""
+        if settings.RECALL_ENABLED:
+            return self._build_prompt(session_id, question)
+        return self._get_context(session_id) + [{"role": "user", "content": question}]
+    
+    def _history_length(self, session_id: str) -> int:
+        """Number of messages stored for a session"""
+        conversation = chat_history_service.conversations.get(session_id)
+        return len(conversation.messages) if conversation else 0
+    
+    def _sync_context(self, session_id: str) -> None:
+        """Reload the context if another worker changed the session in the shared store"""
+        _, _, context_hash = chat_history_service.get_context_state(session_id)
+        # A context this worker never built, or built from a different history, must be reloaded
+        if session_id not in self._active_contexts or self._context_hashes.get(session_id) != context_hash:
+            logger.debug(f"Session {session_id} changed in another worker, reloading context")
+            self.load_history(session_id, chat_history_service.get_message_history(session_id, limit=0))
+    
+    async def _apply_client_state(self, session_id: str, history: Optional[List[Dict[str, str]]], replace_history: bool,
+                            expected_version: Optional[int], expected_hash: Optional[str]) -> None:
+        """Reconcile the stored conversation with the client's view of it; called under the session lock"""
+        has_state, version, context_hash = chat_history_service.get_context_state(session_id)
+        
+        if history is not None:
+            # A resync replaces the stored conversation; otherwise the transcript only seeds a missing one
+            seed = not has_state and history and settings.CHAT_TRUST_CLIENT_HISTORY
+            if (replace_history and (has_state or settings.CHAT_TRUST_CLIENT_HISTORY)) or seed:
+                await chat_history_service.replace_messages(session_id, history)
+                self.load_history(session_id, history)
+            return
+        
+        if expected_version is None and expected_hash is None:
+            return
+        # Check whichever of version and hash the client sent
+        in_sync = (expected_version is None or expected_version == version) and (
+            expected_hash is None or expected_hash == context_hash
+        )
+        if not in_sync:
+            raise ContextOutOfSync(session_id, version, context_hash)
+    
     async def generate_response(self, message: str, session_id: Optional[str] = None) -> str:
         """
-        Generate a response using Groq LLM with conversation memory
+        Generate a response using the configured LLM provider with conversation memory
         
         Args:
             message: The user's message
@@ -46,6 +120,33 @@ class ChatAgentService:
         Returns:
             The agent's response
         """
+        response, _, _ = await self.generate_synced_response(message, session_id)
+        return response
+    
+    async def generate_synced_response(self, message: str, session_id: Optional[str] = None,
+                                       history: Optional[List[Dict[str, str]]] = None, replace_history: bool = False,
+                                       expected_version: Optional[int] = None,
+                                       expected_hash: Optional[str] = None) -> Tuple[str, int, str]:
+        """
+        Generate a response after reconciling the session with the client's view of it
+        
+        The check, any history replacement and the turn itself all run under the
+        session lock, so no other turn can change the conversation in between.
+        
+        Args:
+            message: The user's message
+            session_id: Optional session ID for persistent conversations
+            history: Client transcript before the message, if sent
+            replace_history: Replace the stored conversation with history (resync)
+            expected_version: Context version the client last saw (incremental protocol)
+            expected_hash: Context hash the client last saw (incremental protocol)
+        
+        Returns:
+            The agent's response and the conversation's context version and hash after the turn
+        
+        Raises:
+            ContextOutOfSync: If expected_version or expected_hash do not match the stored conversation
+        """
         try:
             logger.debug(f"Generating response to: {message}")
             logger.debug(f"Using session ID: {session_id}")
@@ -53,14 +154,50 @@ class ChatAgentService:
             if not session_id:
                 session_id = chat_history_service.default_session_id
             
-            # Get current context
-            context = self._get_context(session_id)
+            # Serialize turns of the same session across requests and workers
+            async with chat_history_service.session_lock(session_id):
+                await self._apply_client_state(session_id, history, replace_history, expected_version, expected_hash)
+                response = await self._generate_turn(message, session_id)
+                _, version, context_hash = chat_history_service.get_context_state(session_id)
+                return response, version, context_hash
+                
+        except ContextOutOfSync:
+            raise
+        except SessionLockTimeout as e:
+            # Another request still holds the session, so leave its history alone
+            logger.warning(str(e))
+            error_response = "I'm sorry, this conversation is busy with another request. Please try again in a moment."
+            _, version, context_hash = chat_history_service.get_context_state(session_id)
+            return error_response, version, context_hash
+        except Exception as e:
+            logger.error(f"Error generating agent response: {str(e)}", exc_info=True)
+            error_response = f"I'm sorry, I encountered an error while processing your request. Error: {str(e)}"
+            chat_history_service.add_message(error_response, "assistant", session_id)
+            _, version, context_hash = chat_history_service.get_context_state(session_id)
+            return error_response, version, context_hash
+    
+    async def _generate_turn(self, message: str, session_id: str) -> str:
+        """Generate the response for one turn while holding the session lock"""
+        try:
+            if chat_history_service.store:
+                self._sync_context(session_id)
             
-            # Add user message to context
-            context.append({"role": "user", "content": message})
+            with span("agent.build_context"):
+                # Get current context
+                context = self._get_context(session_id)
+                
+                # Add user message to context
+                context.append({"role": "user", "content": message})
+                
+                # Send recent turns plus relevant older ones instead of the full history
+                prompt = self._build_prompt(session_id, message) if settings.RECALL_ENABLED else context
             
-            # Generate response
-            response = await groq_llm_service.generate_response(context)
+            # Use an answer prefetched for this follow-up, or generate one
+            response = prefetch_service.take(session_id, message, self._history_length(session_id))
+            if response is None:
+                with prefetch_service.real_traffic():
+                    with span("llm.generate_response", provider=self.llm_provider.name, messages=len(prompt)):
+                        response = await self.llm_provider.generate_response(prompt)
             
             # Add response to context
             context.append({"role": "assistant", "content": response})
@@ -69,8 +206,14 @@ class ChatAgentService:
             self._active_contexts[session_id] = context
             
             # Save messages to chat history service
-            chat_history_service.add_message(message, "user", session_id)
-            chat_history_service.add_message(response, "assistant", session_id)
+            with span("chat_history.add_messages"):
+                await chat_history_service.add_messages(session_id, [(message, "user"), (response, "assistant")])
+            
+            # Answer likely follow-ups in the background while the upstream is idle
+            prefetch_service.schedule(
+                session_id, message, self._history_length(session_id),
+                lambda question: self._follow_up_prompt(session_id, question)
+            )
             
             return response
                 
@@ -79,6 +222,9 @@ class ChatAgentService:
             error_response = f"I'm sorry, I encountered an error while processing your request. Error: {str(e)}"
             chat_history_service.add_message(error_response, "assistant", session_id)
             return error_response
+        finally:
+            if chat_history_service.store:
+                self._context_hashes[session_id] = chat_history_service.get_context_state(session_id)[2]
 
 # Create a singleton instance
 chat_agent_service = ChatAgentService()
@@ -1,20 +1,40 @@
+import asyncio
+import hashlib
 import logging
-from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Set, Tuple
 import uuid
 from datetime import datetime
 from app.models.chat import Message, Conversation
+from app.services.recall import recall_service
+from app.services.session_store import SessionStore, session_store
 
 logger = logging.getLogger(__name__)
 
+# Context hash of a conversation without messages
+EMPTY_CONTEXT_HASH = hashlib.sha256(b"").hexdigest()
+
 class ChatHistoryService:
     """Service for managing chat history"""
     
-    def __init__(self):
+    def __init__(self, store: Optional[SessionStore] = None):
         """Initialize chat history service"""
+        # Shared store used when several workers serve the same sessions; conversations
+        # below then act as a local cache validated against the store's version and hash
+        self.store = store or session_store
         # Store conversations by session ID
         self.conversations: Dict[str, Conversation] = {}
-        # Store current session ID for anonymous users
+        # Rolling hash of each conversation's messages, updated on every add
+        self.context_hashes: Dict[str, str] = {}
+        # Serializes turns of the same session within this process; dropped once nobody waits
+        self._session_locks: Dict[str, asyncio.Lock] = {}
+        self._session_lock_users: Dict[str, int] = {}
+        # Sessions whose shared store lock this process holds, so the local copy is authoritative
+        self._held_sessions: Set[str] = set()
+        # Store current session ID for anonymous users, shared by all workers
         self.default_session_id = str(uuid.uuid4())
+        if self.store:
+            self.default_session_id = self.store.get_or_set_value("settings", "default_session_id", self.default_session_id)
         logger.debug(f"Chat history service initialized with default session {self.default_session_id}")
     
     def create_conversation(self, session_id: Optional[str] = None) -> str:
@@ -25,6 +45,10 @@ class ChatHistoryService:
         conversation_id = session_id or str(uuid.uuid4())
         conversation = Conversation(id=conversation_id)
         self.conversations[conversation_id] = conversation
+        self.context_hashes[conversation_id] = EMPTY_CONTEXT_HASH
+        recall_service.clear(conversation_id)
+        if self.store:
+            self.store.create(conversation_id, EMPTY_CONTEXT_HASH)
         logger.debug(f"Created new conversation with ID: {conversation_id}")
         return conversation_id
     
@@ -32,6 +56,7 @@ class ChatHistoryService:
         """Get existing conversation or create a new one if it doesn't exist"""
         conversation_id = session_id or self.default_session_id
         logger.debug(f"Looking for conversation with ID: {conversation_id}")
+        self._refresh_from_store(conversation_id)
         
         if conversation_id not in self.conversations:
             logger.debug(f"Conversation not found, creating new one with ID: {conversation_id}")
@@ -42,6 +67,7 @@ class ChatHistoryService:
     
     def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
         """Get a conversation by ID"""
+        self._refresh_from_store(conversation_id)
         conversation = self.conversations.get(conversation_id)
         if not conversation:
             logger.warning(f"Conversation not found: {conversation_id}")
@@ -62,6 +88,14 @@ class ChatHistoryService:
             return None
         
         message = conversation.add_message(content, role)
+        self.context_hashes[conversation_id] = self.chain_hash(
+            self.context_hashes.get(conversation_id, EMPTY_CONTEXT_HASH), role, content
+        )
+        recall_service.add_message(conversation_id, content, role)
+        if self.store:
+            self.store.append_message(
+                conversation_id, str(message.id), role, content, message.timestamp, self.context_hashes[conversation_id]
+            )
         logger.debug(f"Added {role} message to conversation {conversation_id}: {content[:50]}...")
         logger.debug(f"Conversation {conversation_id} now has {len(conversation.messages)} messages")
         return message
@@ -118,14 +152,168 @@ class ChatHistoryService:
         
         message_count = len(conversation.messages)
         conversation.messages = []
+        self.context_hashes[conversation_id] = EMPTY_CONTEXT_HASH
+        recall_service.clear(conversation_id)
+        if self.store:
+            self.store.reset(conversation_id, EMPTY_CONTEXT_HASH)
         logger.debug(f"Cleared {message_count} messages from conversation: {conversation_id}")
         return True
     
+    def _local_state(self, conversation_id: str) -> Tuple[Optional[int], Optional[str]]:
+        """Get the version and hash of the local copy of a conversation"""
+        conversation = self.conversations.get(conversation_id)
+        if not conversation:
+            return None, None
+        return len(conversation.messages), self.context_hashes.get(conversation_id)
+    
+    def _read_store(self, conversation_id: str, local_version: Optional[int],
+                    local_hash: Optional[str]) -> Tuple[Optional[Tuple[int, str]], Optional[List[Dict]]]:
+        """Read a conversation's state from the store, and its messages if the local copy is stale (blocking)"""
+        state = self.store.get_state(conversation_id)
+        if state is None or state == (local_version, local_hash):
+            return state, None
+        return state, self.store.get_messages(conversation_id)
+    
+    def _refresh_from_store(self, conversation_id: str) -> None:
+        """Bring the local copy of a conversation up to date with the shared session store"""
+        if not self.store or conversation_id in self._held_sessions:
+            return
+        self._apply_store_state(conversation_id, *self._read_store(conversation_id, *self._local_state(conversation_id)))
+    
+    async def refresh(self, conversation_id: str) -> None:
+        """Like _refresh_from_store, reading the store off the event loop"""
+        if not self.store:
+            return
+        state, stored_messages = await asyncio.to_thread(
+            self._read_store, conversation_id, *self._local_state(conversation_id)
+        )
+        self._apply_store_state(conversation_id, state, stored_messages)
+    
+    def _apply_store_state(self, conversation_id: str, state: Optional[Tuple[int, str]],
+                           stored_messages: Optional[List[Dict]]) -> None:
+        """Update the local copy of a conversation from what was read from the store"""
+        if state is None:
+            if conversation_id in self.conversations:
+                # Deleted by another worker
+                del self.conversations[conversation_id]
+                self.context_hashes.pop(conversation_id, None)
+                recall_service.clear(conversation_id)
+            return
+        
+        if stored_messages is None:
+            return
+        
+        # Another worker changed the conversation; reload it and rebuild the recall index
+        version, context_hash = state
+        conversation = Conversation(id=conversation_id)
+        recall_service.clear(conversation_id)
+        for stored in stored_messages:
+            conversation.messages.append(Message(**stored))
+            recall_service.add_message(conversation_id, stored["content"], stored["role"])
+        self.conversations[conversation_id] = conversation
+        self.context_hashes[conversation_id] = context_hash
+        logger.debug(f"Reloaded conversation {conversation_id} from session store at version {version}")
+    
+    @asynccontextmanager
+    async def session_lock(self, conversation_id: str):
+        """
+        Hold a session exclusively, across all workers when a shared store is used
+        While held, the local copy is refreshed once and then trusted without re-reading the store
+        """
+        lock = self._session_locks.setdefault(conversation_id, asyncio.Lock())
+        self._session_lock_users[conversation_id] = self._session_lock_users.get(conversation_id, 0) + 1
+        try:
+            async with lock:
+                if self.store:
+                    async with self.store.lock(conversation_id):
+                        await self.refresh(conversation_id)
+                        self._held_sessions.add(conversation_id)
+                        try:
+                            yield
+                        finally:
+                            self._held_sessions.discard(conversation_id)
+                else:
+                    yield
+        finally:
+            self._session_lock_users[conversation_id] -= 1
+            if not self._session_lock_users[conversation_id]:
+                del self._session_lock_users[conversation_id]
+                del self._session_locks[conversation_id]
+    
+    @staticmethod
+    def chain_hash(previous_hash: str, role: str, content: str) -> str:
+        """Extend a context hash with one message"""
+        return hashlib.sha256(f"{previous_hash}\0{role}\0{content}".encode("utf-8")).hexdigest()
+    
+    def get_context_state(self, conversation_id: str) -> Tuple[bool, int, str]:
+        """
+        Get whether server state exists for a conversation, its version and its hash
+        The version is the number of stored messages
+        """
+        self._refresh_from_store(conversation_id)
+        conversation = self.conversations.get(conversation_id)
+        if not conversation:
+            return False, 0, EMPTY_CONTEXT_HASH
+        return True, len(conversation.messages), self.context_hashes.get(conversation_id, EMPTY_CONTEXT_HASH)
+    
+    async def add_messages(self, conversation_id: str, messages: List[Tuple[str, str]]) -> List[Message]:
+        """
+        Add several (content, role) messages to a conversation while holding its session lock
+        The shared store is written once, in a single transaction off the event loop
+        """
+        conversation = self.conversations.get(conversation_id)
+        if not conversation:
+            conversation = self.conversations[conversation_id] = Conversation(id=conversation_id)
+            self.context_hashes[conversation_id] = EMPTY_CONTEXT_HASH
+            recall_service.clear(conversation_id)
+        
+        added = []
+        for content, role in messages:
+            message = conversation.add_message(content, role)
+            self.context_hashes[conversation_id] = self.chain_hash(self.context_hashes[conversation_id], role, content)
+            recall_service.add_message(conversation_id, content, role)
+            added.append(message)
+        
+        if self.store:
+            await asyncio.to_thread(self.store.append_messages, conversation_id, [
+                {"id": str(m.id), "role": m.role, "content": m.content, "timestamp": m.timestamp} for m in added
+            ], self.context_hashes[conversation_id])
+        logger.debug(f"Added {len(added)} messages to conversation {conversation_id}")
+        return added
+    
+    async def replace_messages(self, conversation_id: str, messages: List[Dict[str, str]]) -> None:
+        """
+        Replace a conversation's messages with a transcript supplied by the client
+        The shared store is updated in a single transaction, so other workers never see a partial transcript
+        """
+        existing = self.conversations.get(conversation_id)
+        conversation = Conversation(id=conversation_id, created_at=existing.created_at) if existing else Conversation(id=conversation_id)
+        context_hash = EMPTY_CONTEXT_HASH
+        recall_service.clear(conversation_id)
+        for message in messages:
+            conversation.add_message(message["content"], message["role"])
+            context_hash = self.chain_hash(context_hash, message["role"], message["content"])
+            recall_service.add_message(conversation_id, message["content"], message["role"])
+        
+        if self.store:
+            await asyncio.to_thread(self.store.replace, conversation_id, [
+                {"id": str(m.id), "role": m.role, "content": m.content, "timestamp": m.timestamp}
+                for m in conversation.messages
+            ], context_hash)
+        self.conversations[conversation_id] = conversation
+        self.context_hashes[conversation_id] = context_hash
+        logger.debug(f"Replaced conversation {conversation_id} with {len(messages)} client messages")
+    
     def delete_conversation(self, conversation_id: str) -> bool:
         """Delete a conversation"""
+        self._refresh_from_store(conversation_id)
         if conversation_id in self.conversations:
             message_count = len(self.conversations[conversation_id].messages)
             del self.conversations[conversation_id]
+            self.context_hashes.pop(conversation_id, None)
+            recall_service.clear(conversation_id)
+            if self.store:
+                self.store.delete(conversation_id)
             logger.debug(f"Deleted conversation: {conversation_id} with {message_count} messages")
             return True
         logger.warning(f"Cannot delete non-existent conversation: {conversation_id}")
@@ -133,7 +321,7 @@ class ChatHistoryService:
 
     def list_all_conversations(self) -> List[str]:
         """List all active conversation IDs for debugging"""
-        conv_list = list(self.conversations.keys())
+        conv_list = self.store.list_sessions() if self.store else list(self.conversations.keys())
         logger.debug(f"Active conversations: {len(conv_list)}")
         return conv_list
 
@@ -0,0 +1,353 @@
+import asyncio
+import logging
+import os
+import shutil
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import UploadFile
+
+from app.core.config import get_settings
+from app.models.document import ChunkResult, DocumentAnalysisJob
+from app.services.llm import LLMProvider
+from app.services.llm_providers import llm_provider
+from app.services.prefetch import prefetch_service
+from app.services.session_store import SessionStore, session_store
+from app.utils.profiling import create_background_task, span
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+# Uploads accepted as plain text; binary formats such as PDF or DOCX are rejected
+TEXT_EXTENSIONS = (".txt", ".md", ".markdown", ".csv", ".json", ".yaml", ".yml")
+
+# Seconds between polls of a job running in another worker
+REMOTE_JOB_POLL_INTERVAL = 0.5
+
+class DocumentTooLargeError(ValueError):
+    """Raised when an uploaded document exceeds the configured size limit"""
+
+def is_text_upload(filename: Optional[str], content_type: Optional[str]) -> bool:
+    """Whether an upload looks like a plain text document"""
+    if content_type and content_type.startswith("text/"):
+        return True
+    return bool(filename) and filename.lower().endswith(TEXT_EXTENSIONS)
+
+class DocumentAnalysisService:
+    """Service for map-reduce gap analysis of documents larger than the model context"""
+
+    def __init__(self, provider: Optional[LLMProvider] = None, store: Optional[SessionStore] = None):
+        """Initialize the document analysis service"""
+        self.llm_provider = provider or llm_provider
+        # Job snapshots are published here so any worker can report progress
+        self.store = store or session_store
+        self.upload_dir = settings.DOCUMENT_UPLOAD_DIR
+        self.system_message = "You are a GRC (Governance, Risk, and Compliance) analyst. You review organizational policies against security and compliance frameworks and report gaps precisely and concisely."
+
+        self.jobs: Dict[str, DocumentAnalysisJob] = {}
+        # Notified on every job update so streaming clients wake up
+        self._conditions: Dict[str, asyncio.Condition] = {}
+        # Keep references to running tasks so they are not garbage collected
+        self._tasks: Dict[str, asyncio.Task] = {}
+        logger.debug("Document analysis service initialized")
+
+    def _document_path(self, job_id: str) -> str:
+        """Get the on-disk path of a job's document"""
+        return os.path.join(self.upload_dir, f"{job_id}.txt")
+
+    async def save_upload(self, job_id: str, upload: UploadFile) -> str:
+        """
+        Move an uploaded file into the upload directory, enforcing the size limit
+
+        The multipart body has already been received and spooled by Starlette at
+        this point, so the limit only prevents analyzing oversized documents; the
+        copy runs in a worker thread to keep the event loop free.
+        """
+        if upload.size is not None and upload.size > settings.DOCUMENT_MAX_UPLOAD_BYTES:
+            raise DocumentTooLargeError(
+                f"Document exceeds the maximum size of {settings.DOCUMENT_MAX_UPLOAD_BYTES} bytes"
+            )
+        os.makedirs(self.upload_dir, exist_ok=True)
+        path = self._document_path(job_id)
+
+        def copy() -> None:
+            upload.file.seek(0)
+            with open(path, "wb") as f:
+                shutil.copyfileobj(upload.file, f)
+
+        try:
+            await asyncio.to_thread(copy)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        logger.debug(f"Saved upload for job {job_id} to {path}")
+        return path
+
+    def save_text(self, job_id: str, text: str) -> str:
+        """Write pasted document text to disk"""
+        if len(text.encode("utf-8")) > settings.DOCUMENT_MAX_UPLOAD_BYTES:
+            raise DocumentTooLargeError(
+                f"Document exceeds the maximum size of {settings.DOCUMENT_MAX_UPLOAD_BYTES} bytes"
+            )
+        os.makedirs(self.upload_dir, exist_ok=True)
+        path = self._document_path(job_id)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    @staticmethod
+    def split_into_chunks(text: str, chunk_chars: int, overlap: int) -> List[str]:
+        """
+        Split text into chunks of at most chunk_chars characters
+
+        Paragraph boundaries are preferred; oversized paragraphs are hard-split.
+        Each chunk after the first starts with the last `overlap` characters of
+        the previous one so requirements spanning a boundary are not lost.
+        """
+        overlap = max(0, min(overlap, chunk_chars // 2))
+        body_chars = chunk_chars - overlap
+
+        pieces: List[str] = []
+        for paragraph in text.split("\n\n"):
+            paragraph = paragraph.strip()
+            while len(paragraph) > body_chars:
+                pieces.append(paragraph[:body_chars])
+                paragraph = paragraph[body_chars:]
+            if paragraph:
+                pieces.append(paragraph)
+
+        bodies: List[str] = []
+        current = ""
+        for piece in pieces:
+            candidate = f"{current}\n\n{piece}" if current else piece
+            if len(candidate) > body_chars and current:
+                bodies.append(current)
+                current = piece
+            else:
+                current = candidate
+        if current:
+            bodies.append(current)
+
+        chunks = []
+        for i, body in enumerate(bodies):
+            if i > 0 and overlap:
+                body = bodies[i - 1][-overlap:] + "\n\n" + body
+            chunks.append(body)
+        return chunks
+
+    def create_job(self, filename: str, framework: str, question: Optional[str] = None) -> DocumentAnalysisJob:
+        """Register a new analysis job"""
+        self._evict_expired_jobs()
+        job = DocumentAnalysisJob(filename=filename, framework=framework, question=question)
+        self.jobs[job.id] = job
+        self._conditions[job.id] = asyncio.Condition()
+        if self.store:
+            self.store.put_value("document_jobs", job.id, self._snapshot(job))
+        logger.debug(f"Created document analysis job {job.id} for {filename} against {framework}")
+        return job
+
+    def _evict_expired_jobs(self) -> None:
+        """Forget jobs that finished more than DOCUMENT_JOB_TTL seconds ago"""
+        for job_id, job in list(self.jobs.items()):
+            if job.is_expired(settings.DOCUMENT_JOB_TTL):
+                del self.jobs[job_id]
+                self._conditions.pop(job_id, None)
+                if self.store:
+                    self.store.delete_value("document_jobs", job_id)
+                logger.debug(f"Evicted finished document analysis job {job_id}")
+
+    def discard_job(self, job_id: str) -> None:
+        """Forget a job that could not be started, e.g. because its document was rejected"""
+        self.jobs.pop(job_id, None)
+        self._conditions.pop(job_id, None)
+        if self.store:
+            self.store.delete_value("document_jobs", job_id)
+        self._remove_document(job_id)
+        logger.debug(f"Discarded document analysis job {job_id}")
+
+    def _remove_document(self, job_id: str) -> None:
+        """Delete a job's document from disk"""
+        path = self._document_path(job_id)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove document {path}: {str(e)}")
+
+    def start_job(self, job: DocumentAnalysisJob) -> None:
+        """Run the job in the background"""
+        task = create_background_task(self._run_job(job), f"document_analysis {job.id}")
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+
+    def get_job(self, job_id: str) -> Optional[DocumentAnalysisJob]:
+        """Get a job by ID, falling back to the snapshot published by another worker"""
+        job = self.jobs.get(job_id)
+        if not job and self.store:
+            snapshot = self.store.get_value("document_jobs", job_id)
+            if snapshot:
+                job = DocumentAnalysisJob.model_validate_json(snapshot)
+        if not job:
+            logger.warning(f"Document analysis job not found: {job_id}")
+        return job
+
+    @staticmethod
+    def _snapshot(job: DocumentAnalysisJob) -> str:
+        """Serialize a job for other workers; per-part results stay with the worker running it"""
+        return job.model_dump_json(exclude={"chunk_results"})
+
+    async def _notify(self, job: DocumentAnalysisJob) -> None:
+        """Record a job update and wake up streaming clients"""
+        job.touch()
+        if self.store:
+            await asyncio.to_thread(self.store.put_value, "document_jobs", job.id, self._snapshot(job))
+        condition = self._conditions.get(job.id)
+        if condition:
+            async with condition:
+                condition.notify_all()
+
+    async def stream_job(self, job_id: str) -> AsyncIterator[DocumentAnalysisJob]:
+        """Yield the job each time it changes until it finishes"""
+        if job_id not in self.jobs:
+            # The job runs in another worker, so follow its published snapshots
+            last_version = -1
+            while True:
+                job = self.get_job(job_id)
+                if job is None:
+                    return
+                if job.version != last_version:
+                    last_version = job.version
+                    yield job
+                if job.is_finished:
+                    return
+                await asyncio.sleep(REMOTE_JOB_POLL_INTERVAL)
+
+        job = self.jobs[job_id]
+        condition = self._conditions[job_id]
+        last_version = -1
+
+        while True:
+            if job.version != last_version:
+                last_version = job.version
+                yield job
+            if job.is_finished:
+                return
+            async with condition:
+                await condition.wait_for(lambda: job.version != last_version)
+
+    def _map_prompt(self, job: DocumentAnalysisJob, part: int, chunk: str) -> List[Dict[str, str]]:
+        """Build the per-chunk gap analysis prompt"""
+        focus = f"\nFocus on: {job.question}" if job.question else ""
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": (
+                f"Below is part {part} of {job.total_chunks} of the policy document \"{job.filename}\".\n"
+                f"Assess it against {job.framework}.{focus}\n"
+                "List the framework requirements this excerpt addresses, the gaps or weaknesses you find, "
+                "and concrete recommendations. Only report what this excerpt supports.\n\n"
+                f"---\n{chunk}\n---"
+            )},
+        ]
+
+    def _reduce_prompt(self, job: DocumentAnalysisJob, partials: List[str], final: bool) -> List[Dict[str, str]]:
+        """Build the prompt merging several partial analyses"""
+        joined = "\n\n".join(f"### Partial analysis {i + 1}\n{p}" for i, p in enumerate(partials))
+        instruction = (
+            "Produce the final gap assessment with sections for covered requirements, gaps ordered by risk, "
+            "and prioritized recommendations."
+            if final else
+            "Merge them into a single partial analysis that keeps every distinct finding."
+        )
+        if final and job.failed_parts:
+            missing = ", ".join(str(part) for part in job.failed_parts)
+            instruction += (
+                f" Parts {missing} of {job.total_chunks} could not be analyzed; state clearly that the assessment "
+                "does not cover them."
+            )
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": (
+                f"The following are gap analyses of different parts of \"{job.filename}\" against {job.framework}. "
+                "A requirement flagged as a gap in one part may be covered in another; resolve such conflicts "
+                f"and remove duplicates. {instruction}\n\n{joined}"
+            )},
+        ]
+
+    async def _run_job(self, job: DocumentAnalysisJob) -> None:
+        """Map each chunk to a partial analysis, then reduce the partials hierarchically"""
+        semaphore = asyncio.Semaphore(max(1, settings.DOCUMENT_ANALYSIS_CONCURRENCY))
+
+        async def limited(messages: List[Dict[str, str]]) -> str:
+            async with semaphore:
+                with prefetch_service.real_traffic():
+                    return await self.llm_provider.generate_response(messages)
+
+        try:
+            with span("documents.split", job_id=job.id):
+                try:
+                    with open(self._document_path(job.id), "r", encoding="utf-8") as f:
+                        text = f.read()
+                except UnicodeDecodeError:
+                    raise ValueError("Document is not UTF-8 text; upload a plain text export of the policy")
+
+                chunks = self.split_into_chunks(text, settings.DOCUMENT_CHUNK_CHARS, settings.DOCUMENT_CHUNK_OVERLAP)
+            if not chunks:
+                raise ValueError("Document is empty")
+
+            job.total_chunks = len(chunks)
+            job.status = "mapping"
+            await self._notify(job)
+            logger.debug(f"Job {job.id}: analyzing {len(chunks)} chunks")
+
+            async def map_chunk(part: int, chunk: str) -> None:
+                try:
+                    content = await limited(self._map_prompt(job, part, chunk))
+                    job.chunk_results.append(ChunkResult(part=part, content=content))
+                except Exception as e:
+                    logger.warning(f"Job {job.id}: part {part} failed: {str(e)}")
+                    job.chunk_results.append(ChunkResult(part=part, error=str(e)))
+                job.completed_chunks += 1
+                await self._notify(job)
+
+            await asyncio.gather(*(map_chunk(part, c) for part, c in enumerate(chunks, start=1)))
+
+            results = sorted(job.chunk_results, key=lambda r: r.part)
+            partials = [r.content for r in results if r.content]
+            job.failed_parts = [r.part for r in results if r.error]
+            if not partials:
+                raise RuntimeError("Analysis failed for every chunk of the document")
+            if job.failed_parts:
+                job.error = f"Analysis failed for parts {job.failed_parts}; the result does not cover them"
+
+            job.status = "reducing"
+            await self._notify(job)
+
+            # Merge level by level; the last level always runs so even a single partial gets the final assessment prompt
+            fanout = max(2, settings.DOCUMENT_REDUCE_FANOUT)
+            while True:
+                groups = [partials[i:i + fanout] for i in range(0, len(partials), fanout)]
+                final = len(groups) == 1
+                logger.debug(f"Job {job.id}: reducing {len(partials)} partials in {len(groups)} groups")
+                partials = await asyncio.gather(*(
+                    limited(self._reduce_prompt(job, group, final)) if len(group) > 1 or final else asyncio.sleep(0, group[0])
+                    for group in groups
+                ))
+                if final:
+                    break
+
+            job.result = partials[0]
+            job.status = "completed"
+            logger.debug(f"Job {job.id}: analysis completed")
+        except Exception as e:
+            logger.error(f"Document analysis job {job.id} failed: {str(e)}", exc_info=True)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            self._remove_document(job.id)
+        await self._notify(job)
+
+# Create singleton instance
+document_analysis_service = DocumentAnalysisService()
@@ -1,16 +1,32 @@
-from groq import Groq
+from groq import AsyncGroq
+import asyncio
 import logging
 import time
 import json
 from app.core.config import get_settings
+from app.utils.profiling import span
 from typing import List, Dict, Any, Optional
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
-class GroqLLMService:
+class LLMProvider:
+    """Base interface for LLM backends used by the chat agent"""
+    
+    name: str = "base"
+    
+    async def generate_response(self, messages: List[Dict[str, str]],
+                              max_tokens: int = settings.AUTOGEN_MAX_TOKENS,
+                              temperature: float = settings.AUTOGEN_TEMPERATURE,
+                              max_retries: int = 3) -> str:
+        """Generate a completion for the given chat messages"""
+        raise NotImplementedError
+
+class GroqLLMService(LLMProvider):
     """Service for interacting with Groq LLM API"""
     
+    name = "groq"
+    
     def __init__(self, api_key: Optional[str] = None, model: Optional[str] = None):
         """Initialize the Groq LLM service"""
         self.api_key = api_key or settings.GROQ_API_KEY
@@ -20,7 +36,7 @@ class GroqLLMService:
             logger.error("GROQ_API_KEY is not set")
             raise ValueError("GROQ_API_KEY is required to use Groq LLM service")
         
-        self.client = Groq(api_key=self.api_key)
+        self.client = AsyncGroq(api_key=self.api_key)
         logger.debug(f"Initialized Groq LLM service with model: {self.model}")
     
     async def generate_response(self, messages: List[Dict[str, str]], 
@@ -36,12 +52,14 @@ class GroqLLMService:
                 logger.debug(f"Generating response with model {self.model}, max_tokens={max_tokens}, temperature={temperature}")
                 logger.debug(f"Messages: {messages}")
                 
-                completion = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature
-                )
+                # The async client lets cancellation (e.g. of prefetch work) abort the HTTP request
+                with span("groq.chat_completion", model=self.model, attempt=retries + 1):
+                    completion = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature
+                    )
                 
                 response = completion.choices[0].message.content
                 logger.debug(f"Generated response: {response}")
@@ -56,14 +74,11 @@ class GroqLLMService:
                     # Exponential backoff
                     wait_time = 2 ** retries
                     logger.info(f"Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
+                    await asyncio.sleep(wait_time)
                 else:
                     logger.error(f"Failed after {max_retries} attempts: {str(e)}", exc_info=True)
                     raise
         
         # If we reach here, all retries failed
         logger.error(f"All retries failed: {str(last_error)}")
-        raise last_error
-
-# Singleton instance
-groq_llm_service = GroqLLMService() 
\ No newline at end of file
+        raise last_error 
\ No newline at end of file
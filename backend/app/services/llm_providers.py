@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+from app.core.config import get_settings
+from app.services.llm import GroqLLMService, LLMProvider
+from app.utils.profiling import span
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+class OpenAICompatibleLLMService(LLMProvider):
+    """Service for any server exposing the OpenAI chat completions API"""
+
+    name = "openai_compatible"
+
+    def __init__(self, base_url: Optional[str] = None, model: Optional[str] = None,
+                 api_key: Optional[str] = None, timeout: Optional[float] = None):
+        """Initialize the OpenAI-compatible LLM service"""
+        self.base_url = (base_url or settings.OPENAI_COMPAT_BASE_URL).rstrip("/")
+        self.model = model or settings.OPENAI_COMPAT_MODEL
+        self.api_key = api_key if api_key is not None else settings.OPENAI_COMPAT_API_KEY
+        self.timeout = timeout or settings.OPENAI_COMPAT_TIMEOUT
+
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+
+        self.client = httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=self.timeout)
+        logger.debug(f"Initialized OpenAI-compatible LLM service at {self.base_url} with model: {self.model}")
+
+    async def generate_response(self, messages: List[Dict[str, str]],
+                              max_tokens: int = settings.AUTOGEN_MAX_TOKENS,
+                              temperature: float = settings.AUTOGEN_TEMPERATURE,
+                              max_retries: int = 3) -> str:
+        """Generate a response from the OpenAI-compatible server with retries"""
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+        for attempt in range(1, max_retries + 1):
+            try:
+                logger.debug(f"Generating response with {self.base_url} model {self.model}, max_tokens={max_tokens}, temperature={temperature}")
+
+                with span("openai_compatible.chat_completion", model=self.model, attempt=attempt):
+                    result = await self.client.post("/chat/completions", json=payload)
+                result.raise_for_status()
+
+                response = result.json()["choices"][0]["message"]["content"]
+                logger.debug(f"Generated response: {response}")
+                return response
+
+            except Exception as e:
+                logger.warning(f"Error generating response from {self.base_url} (attempt {attempt}/{max_retries}): {str(e)}")
+
+                if attempt >= max_retries:
+                    logger.error(f"Failed after {max_retries} attempts: {str(e)}", exc_info=True)
+                    raise
+
+                # Exponential backoff
+                wait_time = 2 ** attempt
+                logger.info(f"Retrying in {wait_time} seconds...")
+                await asyncio.sleep(wait_time)
+
+class RecordReplayLLMService(LLMProvider):
+    """
+    Captures LLM traffic to a JSONL file and plays it back with the original timings
+
+    In "record" mode every call is forwarded to the upstream provider and the
+    request, response and latency are appended to the recording file.
+    In "replay" mode the recording is loaded once and requests are answered
+    from it, sleeping for the recorded latency scaled by the replay speed.
+    """
+
+    def __init__(self, mode: str, path: Optional[str] = None,
+                 upstream: Optional[LLMProvider] = None, speed: Optional[float] = None):
+        """Initialize the record/replay LLM service"""
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown record/replay mode: {mode}")
+        if mode == "record" and upstream is None:
+            raise ValueError("An upstream provider is required in record mode")
+
+        self.mode = mode
+        self.name = mode
+        self.path = path or settings.LLM_RECORDING_PATH
+        self.upstream = upstream
+        self.speed = settings.LLM_REPLAY_SPEED if speed is None else speed
+
+        # Recorded entries by request key, replayed in recording order
+        self._recordings: Dict[str, List[Dict]] = {}
+        self._replay_positions: Dict[str, int] = {}
+
+        if mode == "replay":
+            self._load_recordings()
+        logger.debug(f"Initialized record/replay LLM service in {mode} mode using {self.path}")
+
+    @staticmethod
+    def request_key(messages: List[Dict[str, str]], max_tokens: int, temperature: float) -> str:
+        """Build a stable key identifying a completion request"""
+        raw = json.dumps(
+            {"messages": messages, "max_tokens": max_tokens, "temperature": temperature},
+            sort_keys=True,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _load_recordings(self) -> None:
+        """Load the recording file into memory"""
+        if not os.path.exists(self.path):
+            logger.warning(f"Recording file not found: {self.path}")
+            return
+
+        count = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                self._recordings.setdefault(entry["key"], []).append(entry)
+                count += 1
+        logger.debug(f"Loaded {count} recorded LLM calls from {self.path}")
+
+    def _append_recording(self, entry: Dict) -> None:
+        """Append a single entry to the recording file"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    async def generate_response(self, messages: List[Dict[str, str]],
+                              max_tokens: int = settings.AUTOGEN_MAX_TOKENS,
+                              temperature: float = settings.AUTOGEN_TEMPERATURE,
+                              max_retries: int = 3) -> str:
+        """Record or replay a response depending on the configured mode"""
+        key = self.request_key(messages, max_tokens, temperature)
+
+        if self.mode == "replay":
+            entries = self._recordings.get(key)
+            if not entries:
+                raise LookupError(f"No recorded response for request {key[:12]}")
+
+            # Replay repeated requests in the order they were recorded, sticking to the last one
+            position = self._replay_positions.get(key, 0)
+            entry = entries[min(position, len(entries) - 1)]
+            self._replay_positions[key] = position + 1
+
+            delay = entry.get("latency", 0.0) * self.speed
+            if delay > 0:
+                with span("replay.recorded_latency", delay=delay):
+                    await asyncio.sleep(delay)
+            logger.debug(f"Replayed response for request {key[:12]} after {delay:.3f}s")
+            return entry["response"]
+
+        start = time.perf_counter()
+        response = await self.upstream.generate_response(messages, max_tokens, temperature, max_retries)
+        latency = time.perf_counter() - start
+
+        self._append_recording({
+            "key": key,
+            "provider": self.upstream.name,
+            "recorded_at": datetime.now().isoformat(),
+            "latency": latency,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "response": response,
+        })
+        logger.debug(f"Recorded response for request {key[:12]} ({latency:.3f}s)")
+        return response
+
+class FailoverLLMService(LLMProvider):
+    """Tries a list of providers in order until one of them succeeds"""
+
+    name = "failover"
+
+    def __init__(self, providers: List[LLMProvider]):
+        """Initialize the failover LLM service"""
+        if not providers:
+            raise ValueError("At least one provider is required for failover")
+        self.providers = providers
+        logger.debug(f"Initialized failover LLM service with providers: {[p.name for p in providers]}")
+
+    async def generate_response(self, messages: List[Dict[str, str]],
+                              max_tokens: int = settings.AUTOGEN_MAX_TOKENS,
+                              temperature: float = settings.AUTOGEN_TEMPERATURE,
+                              max_retries: int = 3) -> str:
+        """
+        Generate a response from the first provider that succeeds
+
+        Providers before the last get a single attempt so a dead primary fails
+        over immediately instead of waiting out its retry backoff.
+        """
+        last_error = None
+
+        for i, provider in enumerate(self.providers):
+            attempts = max_retries if i == len(self.providers) - 1 else 1
+            try:
+                with span("failover.attempt", provider=provider.name):
+                    return await provider.generate_response(messages, max_tokens, temperature, attempts)
+            except Exception as e:
+                last_error = e
+                logger.warning(f"Provider {provider.name} failed, trying next provider: {str(e)}")
+
+        logger.error(f"All providers failed: {str(last_error)}")
+        raise last_error
+
+class RateTrackingLLMService(LLMProvider):
+    """Wraps a provider to track in-flight calls and the recent request rate"""
+
+    def __init__(self, provider: LLMProvider, window: float = 60.0):
+        """Initialize the rate tracking wrapper"""
+        self.provider = provider
+        self.name = provider.name
+        self.window = window
+        self.in_flight = 0
+        self._call_times: deque = deque()
+
+    def calls_in_window(self) -> int:
+        """Number of calls started within the tracking window"""
+        cutoff = time.monotonic() - self.window
+        while self._call_times and self._call_times[0] < cutoff:
+            self._call_times.popleft()
+        return len(self._call_times)
+
+    async def generate_response(self, messages: List[Dict[str, str]],
+                              max_tokens: int = settings.AUTOGEN_MAX_TOKENS,
+                              temperature: float = settings.AUTOGEN_TEMPERATURE,
+                              max_retries: int = 3) -> str:
+        """Forward the call to the wrapped provider while tracking it"""
+        self.in_flight += 1
+        self._call_times.append(time.monotonic())
+        try:
+            return await self.provider.generate_response(messages, max_tokens, temperature, max_retries)
+        finally:
+            self.in_flight -= 1
+
+def create_llm_provider(name: str) -> LLMProvider:
+    """Create a single LLM provider by name"""
+    name = name.strip().lower()
+
+    if name == "groq":
+        return GroqLLMService()
+    if name == "openai_compatible":
+        return OpenAICompatibleLLMService()
+    if name == "record":
+        if settings.LLM_RECORD_UPSTREAM.strip().lower() in ("record", "replay"):
+            raise ValueError("LLM_RECORD_UPSTREAM must name a live provider, not record or replay")
+        return RecordReplayLLMService("record", upstream=create_llm_provider(settings.LLM_RECORD_UPSTREAM))
+    if name == "replay":
+        return RecordReplayLLMService("replay")
+
+    raise ValueError(f"Unknown LLM provider: {name}")
+
+def get_llm_provider() -> LLMProvider:
+    """Build the configured LLM provider, wrapped in failover when fallbacks are set and in rate tracking"""
+    names = [settings.LLM_PROVIDER]
+    names += [n for n in settings.LLM_FALLBACK_PROVIDERS.split(",") if n.strip()]
+
+    providers = [create_llm_provider(n) for n in names]
+    logger.debug(f"Using LLM providers: {[p.name for p in providers]}")
+
+    provider = providers[0] if len(providers) == 1 else FailoverLLMService(providers)
+    return RateTrackingLLMService(provider)
+
+# Singleton instance
+llm_provider = get_llm_provider()
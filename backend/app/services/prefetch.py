@@ -0,0 +1,195 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set
+
+from app.core.config import get_settings
+from app.services.llm import LLMProvider
+from app.services.llm_providers import llm_provider
+from app.services.recall import tokenize
+from app.services.session_store import session_store
+from app.utils.profiling import create_background_task, span
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Follow-ups GRC users most often ask after an answer, in priority order
+FOLLOW_UP_QUESTIONS = [
+    "What evidence do I need?",
+    "How does this map to ISO 27001?",
+    "How does this map to NIST CSF?",
+    "What are the risks if this is not implemented?",
+    "How should we implement this?",
+]
+
+@dataclass
+class PrefetchedAnswer:
+    """Answer generated ahead of time for a predicted follow-up"""
+    question: str
+    terms: Set[str]
+    answer: str
+    # Number of messages in the conversation when the answer was generated
+    history_length: int
+
+def _similarity(a: Set[str], b: Set[str]) -> float:
+    """Jaccard similarity of two term sets"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class PrefetchService:
+    """
+    Service answering predicted follow-up questions while the upstream is idle
+
+    Prefetching only starts once no real request is in flight, the upstream has
+    been idle for PREFETCH_IDLE_DELAY and enough of the rate limit is unused.
+    Any real request cancels all prefetch work immediately.
+    """
+
+    def __init__(self, provider: Optional[LLMProvider] = None):
+        """Initialize the prefetch service"""
+        self.llm_provider = provider or llm_provider
+        self._answers: Dict[str, List[PrefetchedAnswer]] = {}
+        # Running prefetch task per session
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._real_in_flight = 0
+        
+        # Headroom, in-flight calls and prefetched answers are tracked per process, so with several
+        # workers each one would overestimate the spare rate limit and rarely see the next turn
+        self.enabled = settings.PREFETCH_ENABLED
+        if self.enabled and session_store is not None:
+            logger.warning("Follow-up prefetch is not supported with a shared session store; disabling it")
+            self.enabled = False
+
+        self.stats = {"lookups": 0, "hits": 0, "generated": 0, "cancelled": 0, "skipped": 0}
+        logger.debug("Prefetch service initialized")
+
+    @contextmanager
+    def real_traffic(self):
+        """Mark a real upstream request, cancelling any prefetch work in progress"""
+        self._real_in_flight += 1
+        self.cancel_all()
+        try:
+            yield
+        finally:
+            self._real_in_flight -= 1
+
+    def cancel_all(self) -> None:
+        """Cancel all running prefetch tasks"""
+        for session_id in list(self._tasks):
+            self._cancel(session_id)
+
+    def _cancel(self, session_id: str) -> None:
+        """Cancel the prefetch task of a session"""
+        task = self._tasks.pop(session_id, None)
+        if task and not task.done():
+            task.cancel()
+            self.stats["cancelled"] += 1
+
+    def clear(self, session_id: str) -> None:
+        """Cancel prefetching and drop prefetched answers for a session"""
+        self._cancel(session_id)
+        self._answers.pop(session_id, None)
+
+    def _has_capacity(self) -> bool:
+        """Whether the upstream is idle and has enough rate-limit headroom"""
+        if self._real_in_flight:
+            return False
+        if getattr(self.llm_provider, "in_flight", 0):
+            return False
+        calls_in_window = getattr(self.llm_provider, "calls_in_window", None)
+        if calls_in_window and settings.LLM_RATE_LIMIT_RPM > 0:
+            headroom = 1 - calls_in_window() / settings.LLM_RATE_LIMIT_RPM
+            if headroom < settings.PREFETCH_MIN_HEADROOM:
+                return False
+        return True
+
+    @staticmethod
+    def predict_follow_ups(message: str, limit: int) -> List[str]:
+        """Pick the likely follow-ups that the current message does not already cover"""
+        message_terms = set(tokenize(message))
+        predictions = []
+        for question in FOLLOW_UP_QUESTIONS:
+            question_terms = set(tokenize(question))
+            # Skip follow-ups about something the user just asked, e.g. a mapping to the same framework
+            if question_terms & message_terms - {"map", "need", "implement", "implemented"}:
+                continue
+            predictions.append(question)
+            if len(predictions) >= limit:
+                break
+        return predictions
+
+    def take(self, session_id: str, message: str, history_length: int) -> Optional[str]:
+        """Return and consume a prefetched answer matching the message, if any"""
+        if not self.enabled:
+            return None
+
+        self.stats["lookups"] += 1
+        # Whatever the outcome, answers prefetched for the previous turn are now stale
+        self._cancel(session_id)
+        answers = self._answers.pop(session_id, None)
+        if not answers:
+            return None
+
+        message_terms = set(tokenize(message))
+        best = max(answers, key=lambda a: _similarity(a.terms, message_terms))
+
+        if best.history_length == history_length and _similarity(best.terms, message_terms) >= settings.PREFETCH_MATCH_THRESHOLD:
+            self.stats["hits"] += 1
+            logger.debug(f"Prefetch hit for session {session_id}: {best.question}")
+            return best.answer
+
+        logger.debug(f"Prefetch miss for session {session_id}")
+        return None
+
+    def schedule(self, session_id: str, message: str, history_length: int,
+                 build_prompt: Callable[[str], List[Dict[str, str]]]) -> None:
+        """Start prefetching follow-up answers for a session in the background"""
+        if not self.enabled:
+            return
+
+        self.clear(session_id)
+        questions = self.predict_follow_ups(message, settings.PREFETCH_MAX_FOLLOWUPS)
+        if not questions:
+            return
+
+        task = create_background_task(self._prefetch(session_id, questions, history_length, build_prompt), f"prefetch {session_id}")
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(session_id, None) if self._tasks.get(session_id) is t else None)
+
+    async def _prefetch(self, session_id: str, questions: List[str], history_length: int,
+                        build_prompt: Callable[[str], List[Dict[str, str]]]) -> None:
+        """Generate answers one at a time, stopping as soon as capacity runs out"""
+        try:
+            await asyncio.sleep(settings.PREFETCH_IDLE_DELAY)
+            answers: List[PrefetchedAnswer] = []
+
+            for question in questions:
+                if not self._has_capacity():
+                    self.stats["skipped"] += 1
+                    logger.debug(f"No spare upstream capacity, stopping prefetch for session {session_id}")
+                    break
+
+                with span("prefetch.generate_response", question=question):
+                    answer = await self.llm_provider.generate_response(build_prompt(question))
+
+                answers.append(PrefetchedAnswer(question, set(tokenize(question)), answer, history_length))
+                # Publish each answer as soon as it is ready
+                self._answers[session_id] = list(answers)
+                self.stats["generated"] += 1
+                logger.debug(f"Prefetched answer for session {session_id}: {question}")
+        except asyncio.CancelledError:
+            logger.debug(f"Prefetch for session {session_id} cancelled by real traffic")
+            raise
+        except Exception as e:
+            logger.warning(f"Prefetch for session {session_id} failed: {str(e)}")
+
+    def get_stats(self) -> Dict[str, float]:
+        """Get prefetch counters and the hit rate"""
+        stats = dict(self.stats)
+        stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+# Create singleton instance
+prefetch_service = PrefetchService()
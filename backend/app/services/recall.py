@@ -0,0 +1,138 @@
+import logging
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-.][a-z0-9]+)*")
+
+_STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in into is it its me my of on or our
+so that the their them then there these they this to was we were what when where which who why will with
+you your yes no not please thanks thank about should would could
+""".split())
+
+# BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase and split text into terms, keeping identifiers like 'iso-27001' or 'ac-2' intact"""
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+class TurnRecallIndex:
+    """Incremental BM25 index over the messages of one conversation"""
+
+    def __init__(self):
+        self.messages: List[Tuple[str, str]] = []
+        self._term_counts: List[Counter] = []
+        self._doc_freq: Counter = Counter()
+        self._total_length = 0
+
+    def add(self, content: str, role: str) -> None:
+        """Index a new message; its position is the message's index in the conversation"""
+        terms = Counter(tokenize(content))
+        self.messages.append((role, content))
+        self._term_counts.append(terms)
+        self._doc_freq.update(terms.keys())
+        self._total_length += sum(terms.values())
+
+    def score(self, query: str, end: int) -> List[Tuple[float, int]]:
+        """Score messages before position `end` against the query, best first"""
+        query_terms = set(tokenize(query))
+        count = len(self.messages)
+        if not query_terms or not count or end <= 0:
+            return []
+
+        average_length = self._total_length / count or 1.0
+        idf = {
+            term: math.log(1 + (count - self._doc_freq[term] + 0.5) / (self._doc_freq[term] + 0.5))
+            for term in query_terms if self._doc_freq[term]
+        }
+        if not idf:
+            return []
+
+        scored = []
+        for position in range(min(end, count)):
+            terms = self._term_counts[position]
+            length = sum(terms.values())
+            score = 0.0
+            for term, weight in idf.items():
+                frequency = terms.get(term)
+                if frequency:
+                    score += weight * frequency * (_K1 + 1) / (frequency + _K1 * (1 - _B + _B * length / average_length))
+            if score > 0:
+                scored.append((score, position))
+
+        scored.sort(reverse=True)
+        return scored
+
+class RecallService:
+    """Service selecting the older conversation turns relevant to a new message"""
+
+    def __init__(self):
+        """Initialize the recall service"""
+        self._indexes: Dict[str, TurnRecallIndex] = {}
+        logger.debug("Recall service initialized")
+
+    def add_message(self, conversation_id: str, content: str, role: str) -> None:
+        """Add a message to the conversation's recall index"""
+        index = self._indexes.setdefault(conversation_id, TurnRecallIndex())
+        index.add(content, role)
+
+    def clear(self, conversation_id: str) -> None:
+        """Drop the recall index of a conversation"""
+        self._indexes.pop(conversation_id, None)
+
+    def build_history(self, conversation_id: str, query: str,
+                      recent_messages: int = settings.RECALL_RECENT_MESSAGES,
+                      top_k: int = settings.RECALL_TOP_K,
+                      budget_chars: int = settings.RECALL_BUDGET_CHARS) -> List[Dict[str, str]]:
+        """
+        Get the messages to send as history for a new query
+
+        Returns the most recent messages plus the older ones most relevant to the
+        query that fit in the character budget, in chronological order. A recalled
+        user message brings its answer along (and vice versa) when the budget and
+        top_k allow; partners count toward top_k like any other message.
+        """
+        index = self._indexes.get(conversation_id)
+        if not index:
+            return []
+
+        count = len(index.messages)
+        recent_start = max(0, count - recent_messages)
+
+        selected: List[int] = []
+        used = 0
+        for _, position in index.score(query, recent_start):
+            if len(selected) >= top_k:
+                break
+            if position in selected:
+                continue
+            size = len(index.messages[position][1])
+            if used + size > budget_chars:
+                continue
+            selected.append(position)
+            used += size
+
+            # Pull in the other half of the exchange so the recalled turn reads naturally
+            role = index.messages[position][0]
+            partner = position + 1 if role == "user" else position - 1
+            if len(selected) < top_k and 0 <= partner < recent_start and partner not in selected:
+                partner_size = len(index.messages[partner][1])
+                if used + partner_size <= budget_chars:
+                    selected.append(partner)
+                    used += partner_size
+
+        positions = sorted(selected) + list(range(recent_start, count))
+        logger.debug(f"Recalled {len(selected)} of {recent_start} older messages ({used} chars) for conversation {conversation_id}")
+        return [{"role": index.messages[p][0], "content": index.messages[p][1]} for p in positions]
+
+# Create singleton instance
+recall_service = RecallService()
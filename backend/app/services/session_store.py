@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Seconds between attempts to take a session lock held by another worker
+LOCK_POLL_INTERVAL = 0.01
+
+# Fraction of the lease TTL after which a held session lock is renewed
+LOCK_RENEW_FRACTION = 1 / 3
+
+class SessionLockTimeout(TimeoutError):
+    """Raised when a session lock held elsewhere is not released in time"""
+
+class SessionStore:
+    """
+    Base interface for session state shared by all worker processes
+
+    Implementations keep each session's messages together with a version (the
+    message count) and the rolling context hash, so workers can cheaply check
+    whether their local copy is current. A networked backend implementing this
+    interface carries the same design across several nodes. Methods other than
+    lock() block, so the request path calls them through asyncio.to_thread.
+    """
+
+    def get_state(self, session_id: str) -> Optional[Tuple[int, str]]:
+        """Get the version and context hash of a session, or None if it does not exist"""
+        raise NotImplementedError
+
+    def get_messages(self, session_id: str) -> List[Dict]:
+        """Get a session's messages as dicts with id, role, content and timestamp"""
+        raise NotImplementedError
+
+    def create(self, session_id: str, context_hash: str) -> None:
+        """Create a session with no messages unless it already exists"""
+        raise NotImplementedError
+
+    def reset(self, session_id: str, context_hash: str) -> None:
+        """Remove all of a session's messages, creating the session if needed"""
+        raise NotImplementedError
+
+    def append_message(self, session_id: str, message_id: str, role: str, content: str,
+                       timestamp: datetime, context_hash: str) -> None:
+        """Append a message and record the session's new context hash"""
+        raise NotImplementedError
+
+    def append_messages(self, session_id: str, messages: List[Dict], context_hash: str) -> None:
+        """Append several messages (dicts as returned by get_messages) in one step"""
+        raise NotImplementedError
+
+    def replace(self, session_id: str, messages: List[Dict], context_hash: str) -> None:
+        """Replace all of a session's messages (dicts as returned by get_messages) in one step"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        """Delete a session"""
+        raise NotImplementedError
+
+    def list_sessions(self) -> List[str]:
+        """List all session IDs"""
+        raise NotImplementedError
+
+    def get_or_set_value(self, namespace: str, key: str, value: str) -> str:
+        """Store a value unless one exists, returning the stored value"""
+        raise NotImplementedError
+
+    def put_value(self, namespace: str, key: str, value: str) -> None:
+        """Store a value, replacing any previous one"""
+        raise NotImplementedError
+
+    def get_value(self, namespace: str, key: str) -> Optional[str]:
+        """Get a stored value"""
+        raise NotImplementedError
+
+    def delete_value(self, namespace: str, key: str) -> None:
+        """Delete a stored value"""
+        raise NotImplementedError
+
+    def lock(self, session_id: str):
+        """Async context manager holding the session lock across all workers"""
+        raise NotImplementedError
+
+class SqliteSessionStore(SessionStore):
+    """
+    Session store in a local SQLite database shared by the workers on one node
+
+    WAL mode lets readers proceed while a writer commits, so version checks stay
+    in the microsecond range. Session locks are leases with an expiry, so a
+    crashed worker cannot hold a session forever. Each thread uses its own
+    connection, so calls can be moved off the event loop with asyncio.to_thread.
+    """
+
+    def __init__(self, path: Optional[str] = None, lock_timeout: Optional[float] = None,
+                 lock_ttl: Optional[float] = None):
+        """Initialize the SQLite session store"""
+        self.path = path or settings.SESSION_STORE_PATH
+        self.lock_timeout = lock_timeout or settings.SESSION_LOCK_TIMEOUT
+        self.lock_ttl = lock_ttl or settings.SESSION_LOCK_TTL
+        self._local = threading.local()
+        self._connection()
+        logger.debug(f"Initialized SQLite session store at {self.path}")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get this thread's connection, reconnecting after a fork"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    context_hash TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    message_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                );
+                CREATE TABLE IF NOT EXISTS session_locks (
+                    session_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS kv (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                );
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_state(self, session_id: str) -> Optional[Tuple[int, str]]:
+        row = self._connection().execute(
+            "SELECT version, context_hash FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def get_messages(self, session_id: str) -> List[Dict]:
+        rows = self._connection().execute(
+            "SELECT message_id, role, content, timestamp FROM messages WHERE session_id = ? ORDER BY seq",
+            (session_id,)
+        ).fetchall()
+        return [
+            {"id": r[0], "role": r[1], "content": r[2], "timestamp": datetime.fromisoformat(r[3])}
+            for r in rows
+        ]
+
+    def create(self, session_id: str, context_hash: str) -> None:
+        self._connection().execute(
+            "INSERT OR IGNORE INTO sessions (session_id, version, context_hash, updated_at) VALUES (?, 0, ?, ?)",
+            (session_id, context_hash, time.time())
+        )
+
+    def reset(self, session_id: str, context_hash: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, version, context_hash, updated_at) VALUES (?, 0, ?, ?)",
+                (session_id, context_hash, time.time())
+            )
+
+    def append_message(self, session_id: str, message_id: str, role: str, content: str,
+                       timestamp: datetime, context_hash: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            version = row[0] if row else 0
+            conn.execute(
+                "INSERT INTO messages (session_id, seq, message_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, version, message_id, role, content, timestamp.isoformat())
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, version, context_hash, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, version + 1, context_hash, time.time())
+            )
+
+    def append_messages(self, session_id: str, messages: List[Dict], context_hash: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            version = row[0] if row else 0
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, message_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, version + i, m["id"], m["role"], m["content"], m["timestamp"].isoformat())
+                    for i, m in enumerate(messages)
+                ]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, version, context_hash, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, version + len(messages), context_hash, time.time())
+            )
+
+    def replace(self, session_id: str, messages: List[Dict], context_hash: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, message_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, seq, m["id"], m["role"], m["content"], m["timestamp"].isoformat())
+                    for seq, m in enumerate(messages)
+                ]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, version, context_hash, updated_at) VALUES (?, ?, ?, ?)",
+                (session_id, len(messages), context_hash, time.time())
+            )
+
+    def delete(self, session_id: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def list_sessions(self) -> List[str]:
+        return [r[0] for r in self._connection().execute("SELECT session_id FROM sessions").fetchall()]
+
+    def get_or_set_value(self, namespace: str, key: str, value: str) -> str:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO kv (namespace, key, value) VALUES (?, ?, ?)", (namespace, key, value))
+            row = conn.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return row[0]
+
+    def put_value(self, namespace: str, key: str, value: str) -> None:
+        self._connection().execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)", (namespace, key, value)
+        )
+
+    def get_value(self, namespace: str, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def delete_value(self, namespace: str, key: str) -> None:
+        self._connection().execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def _try_acquire(self, session_id: str, owner: str) -> bool:
+        """Take the session lease if it is free or expired"""
+        now = time.time()
+        conn = self._connection()
+        # Check with a plain read first so waiting workers do not queue up for the write lock
+        row = conn.execute("SELECT expires_at FROM session_locks WHERE session_id = ?", (session_id,)).fetchone()
+        if row and row[0] >= now:
+            return False
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM session_locks WHERE session_id = ? AND expires_at < ?", (session_id, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO session_locks (session_id, owner, expires_at) VALUES (?, ?, ?)",
+                (session_id, owner, now + self.lock_ttl)
+            )
+            return cursor.rowcount == 1
+
+    def _renew(self, session_id: str, owner: str) -> bool:
+        """Extend the session lease, returning False if this owner lost it"""
+        cursor = self._connection().execute(
+            "UPDATE session_locks SET expires_at = ? WHERE session_id = ? AND owner = ?",
+            (time.time() + self.lock_ttl, session_id, owner)
+        )
+        return cursor.rowcount == 1
+
+    async def _keep_alive(self, session_id: str, owner: str) -> None:
+        """Renew the lease while the lock is held, so slow turns do not outlive it"""
+        while True:
+            await asyncio.sleep(self.lock_ttl * LOCK_RENEW_FRACTION)
+            try:
+                if not await asyncio.to_thread(self._renew, session_id, owner):
+                    logger.error(f"Lost the lock on session {session_id} while holding it")
+                    return
+            except Exception as e:
+                logger.warning(f"Failed to renew the lock on session {session_id}: {str(e)}")
+
+    def _release(self, session_id: str, owner: str) -> None:
+        """Give up the session lease if this owner still holds it"""
+        self._connection().execute(
+            "DELETE FROM session_locks WHERE session_id = ? AND owner = ?", (session_id, owner)
+        )
+
+    @asynccontextmanager
+    async def lock(self, session_id: str):
+        owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        deadline = time.monotonic() + self.lock_timeout
+
+        while not await asyncio.to_thread(self._try_acquire, session_id, owner):
+            if time.monotonic() > deadline:
+                raise SessionLockTimeout(f"Timed out waiting for the lock on session {session_id}")
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+        heartbeat = asyncio.create_task(self._keep_alive(session_id, owner))
+        try:
+            yield
+        finally:
+            heartbeat.cancel()
+            await asyncio.to_thread(self._release, session_id, owner)
+
+def get_session_store() -> Optional[SessionStore]:
+    """Build the configured shared session store, or None to keep state in process"""
+    backend = settings.SESSION_STORE.strip().lower()
+
+    if backend in ("", "memory"):
+        if int(os.getenv("WEB_CONCURRENCY", "1") or 1) > 1:
+            logger.warning("Running several workers with in-process session state; set SESSION_STORE=sqlite")
+        return None
+    if backend == "sqlite":
+        return SqliteSessionStore()
+
+    raise ValueError(f"Unknown session store: {settings.SESSION_STORE}")
+
+# Singleton instance
+session_store = get_session_store()
@@ -0,0 +1,276 @@
+"""
+Opt-in per-request profiling
+
+A request is traced when it carries the X-Profile header ("1" for spans,
+"stacks" to also run the sampling profiler) or when it falls within
+PROFILING_SAMPLE_RATE. Code marks stages with `span("name")`; when the
+current request is not traced this returns a shared no-op context manager,
+so instrumentation costs a single context variable lookup.
+
+Traces are written one per line to a rotating file in the Chrome Trace
+Event format, which chrome://tracing, Perfetto and speedscope can load.
+
+CPU times and stack samples are taken for the event loop thread, so they
+include work done for other requests running concurrently with the traced one.
+Background tasks started with `create_background_task` get a trace of their own.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import nullcontext
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Any, Coroutine, Dict, List, Optional
+
+from app.core.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_TOKEN_HEADER = b"x-profile-token"
+TRACE_ID_HEADER = b"x-trace-id"
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("profiling_trace", default=None)
+_current_span: ContextVar[Optional[int]] = ContextVar("profiling_span", default=None)
+_NOOP_SPAN = nullcontext()
+
+class Trace:
+    """Span tree and optional stack samples collected for a single request"""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.events: List[Dict[str, Any]] = []
+        self.stacks: Counter = Counter()
+        self._next_span_id = 0
+        self._origin = time.perf_counter()
+
+    def new_span_id(self) -> int:
+        self._next_span_id += 1
+        return self._next_span_id
+
+    def timestamp_us(self, perf_time: float) -> float:
+        """Convert a perf_counter value to microseconds since the trace started"""
+        return (perf_time - self._origin) * 1_000_000
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Render the trace in the Chrome Trace Event format"""
+        return {
+            "traceEvents": self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "trace_id": self.id,
+                "name": self.name,
+                # Collapsed stacks ("frame;frame;frame count"), as consumed by flamegraph tools
+                "stacks": [f"{stack} {count}" for stack, count in self.stacks.most_common()],
+            },
+        }
+
+class _Span:
+    """Context manager recording wall and CPU time of one stage"""
+
+    __slots__ = ("trace", "name", "args", "span_id", "start", "cpu_start", "token")
+
+    def __init__(self, trace: Trace, name: str, args: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> "_Span":
+        self.span_id = self.trace.new_span_id()
+        self.args["span_id"] = self.span_id
+        self.args["parent_id"] = _current_span.get()
+        self.token = _current_span.set(self.span_id)
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        end = time.perf_counter()
+        # Thread CPU time includes any other tasks the event loop ran while this span was awaiting
+        self.args["cpu_ms"] = round((time.thread_time() - self.cpu_start) * 1000, 3)
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _current_span.reset(self.token)
+
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        self.trace.events.append({
+            "name": self.name,
+            "ph": "X",
+            "ts": self.trace.timestamp_us(self.start),
+            "dur": (end - self.start) * 1_000_000,
+            "pid": os.getpid(),
+            # Concurrent tasks get their own row so overlapping spans stay nested
+            "tid": id(task) if task else threading.get_ident(),
+            "args": self.args,
+        })
+
+def span(name: str, **args: Any):
+    """Time a stage of the current request; a no-op when the request is not traced"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _Span(trace, name, args)
+
+def current_trace() -> Optional[Trace]:
+    """Get the trace of the current request, if it is being profiled"""
+    return _current_trace.get()
+
+def create_background_task(coro: Coroutine, name: str) -> asyncio.Task:
+    """
+    Start a task that outlives the current request
+
+    The task never records into the request's trace, which is written as soon as
+    the response is sent. If the request is traced, the task gets its own trace,
+    written when the task finishes.
+    """
+    parent = _current_trace.get()
+    trace = Trace(name) if parent is not None else None
+
+    async def run():
+        if trace is None:
+            return await coro
+        try:
+            with span(name, kind="background", parent_trace_id=parent.id):
+                return await coro
+        finally:
+            try:
+                trace_writer.write(trace)
+            except Exception as e:
+                logger.error(f"Failed to write trace {trace.id}: {str(e)}", exc_info=True)
+
+    # create_task copies the current context, so swap in the task's own trace while creating it
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        return asyncio.create_task(run())
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+class StackSampler(threading.Thread):
+    """Background thread sampling the stack of the event loop thread"""
+
+    def __init__(self, trace: Trace, thread_id: int, interval: float):
+        super().__init__(name=f"stack-sampler-{trace.id[:8]}", daemon=True)
+        self.trace = trace
+        self.thread_id = thread_id
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if frames:
+                self.trace.stacks[";".join(reversed(frames))] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+class TraceWriter:
+    """Writes finished traces to a rotating JSON lines file"""
+
+    def __init__(self, path: str, max_bytes: int, backup_count: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._logger: Optional[logging.Logger] = None
+
+    def _get_logger(self) -> logging.Logger:
+        """Create the trace file handler on first use"""
+        if self._logger is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backup_count, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            trace_logger = logging.getLogger("app.profiling.traces")
+            trace_logger.handlers = [handler]
+            trace_logger.setLevel(logging.INFO)
+            trace_logger.propagate = False
+            self._logger = trace_logger
+        return self._logger
+
+    def write(self, trace: Trace) -> None:
+        self._get_logger().info(json.dumps(trace.to_chrome_trace()))
+        logger.debug(f"Wrote trace {trace.id} for {trace.name} to {self.path}")
+
+trace_writer = TraceWriter(settings.PROFILING_TRACE_PATH, settings.PROFILING_MAX_BYTES, settings.PROFILING_BACKUP_COUNT)
+
+class ProfilingMiddleware:
+    """ASGI middleware tracing requests that opt in or are sampled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _profile_mode(self, scope) -> Optional[str]:
+        """Return None, "spans" or "stacks" for the incoming request"""
+        if settings.PROFILING_HEADER_ENABLED:
+            requested = None
+            token = ""
+            for key, value in scope.get("headers", ()):
+                if key == PROFILE_HEADER:
+                    requested = value.decode("latin-1").strip().lower()
+                elif key == PROFILE_TOKEN_HEADER:
+                    token = value.decode("latin-1").strip()
+            if requested is not None:
+                if settings.PROFILING_HEADER_SECRET and not hmac.compare_digest(token, settings.PROFILING_HEADER_SECRET):
+                    return None
+                if requested == "stacks":
+                    return "stacks"
+                if requested in ("1", "true", "spans"):
+                    return "spans"
+                return None
+        if settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE:
+            return "spans"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        mode = self._profile_mode(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = _current_trace.set(trace)
+        sampler = None
+        if mode == "stacks":
+            sampler = StackSampler(trace, threading.get_ident(), settings.PROFILING_STACK_INTERVAL)
+            sampler.start()
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(TRACE_ID_HEADER, trace.id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            with span(trace.name, kind="request"):
+                await self.app(scope, receive, send_with_trace_id)
+        finally:
+            if sampler:
+                sampler.stop()
+            _current_trace.reset(token)
+            try:
+                trace_writer.write(trace)
+            except Exception as e:
+                logger.error(f"Failed to write trace {trace.id}: {str(e)}", exc_info=True)